@@ -16,21 +16,21 @@ Como usar:
 """
 
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import json
-import os
 import io
-import tempfile
 import re
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from decimal import Decimal, InvalidOperation
 from dateutil import parser as dateparser
-import pandas as pd
-import fitz  # PyMuPDF
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseDownload
-from google.cloud import vision_v1
-from lxml import etree
 
 # -------------------------
 # CONFIG
@@ -41,12 +41,67 @@ SCOPES = [
 ]
 VISION_SCOPE = "https://www.googleapis.com/auth/cloud-platform"
 
-# Regex patterns
-CNPJ_REGEX = re.compile(r'(\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2}|\d{14})')
-CPF_REGEX = re.compile(r'(\d{3}\.\d{3}\.\d{3}-\d{2}|\d{11})')
-VALUE_REGEX = re.compile(r'\d{1,3}(?:[.,]\d{3})*[.,]\d{2}')
-NOTE_NUMBER_REGEX = re.compile(r'(?:N(?:º|o)?\.?\s*|Nota\s*Fiscal\s*[:\-]?\s*)(\d{1,12})', re.IGNORECASE)
-DATE_REGEX = re.compile(r'(\d{2}/\d{2}/\d{4}|\d{4}-\d{2}-\d{2})')
+# Regex patterns (os lookarounds impedem casar pedaços de números maiores, ex.: a chave de acesso de 44 dígitos)
+CNPJ_REGEX = re.compile(r'(?<!\d)(\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2}|\d{14})(?!\d)')
+CPF_REGEX = re.compile(r'(?<![\d./])(\d{3}\.\d{3}\.\d{3}-\d{2}|\d{11})(?!\d)')
+# valores com separador de milhar (1.234,56) ou sem (1234,56, comum em OCR e cupons)
+VALUE_REGEX = re.compile(r'(?<![\d.,])(?:\d{1,3}(?:[.,]\d{3})+|\d+)[.,]\d{2}(?!\d)')
+# número fica num lookahead: o match consome só o rótulo e os dígitos seguem disponíveis para os outros padrões em FIELDS_REGEX
+NOTE_NUMBER_REGEX = re.compile(r'(?:\bN(?:º|o)?\.?\s*|\bNota\s*Fiscal\s*[:\-]?\s*)(?=(?P<nota>\d{1,12})(?!\d))', re.IGNORECASE)
+DATE_REGEX = re.compile(r'(?<!\d)(\d{2}/\d{2}/\d{4}|\d{4}-\d{2}-\d{2})(?!\d)')
+# Os quatro campos acima numa só alternação (grupos nomeados) para uma única varredura do texto
+FIELDS_REGEX = re.compile(
+    f"(?P<cnpj>{CNPJ_REGEX.pattern})|(?P<cpf>{CPF_REGEX.pattern})|(?P<date>{DATE_REGEX.pattern})|{NOTE_NUMBER_REGEX.pattern}",
+    re.IGNORECASE
+)
+
+NON_DIGIT_REGEX = re.compile(r'\D')
+
+# Pontuação de CNPJ/CPF e separadores de valores monetários (removidos via str.translate)
+DOCUMENT_PUNCTUATION = str.maketrans("", "", "./-")
+MONEY_SEPARATORS = str.maketrans("", "", ".,")
+
+# Campos da nota que extract_basic_fields_from_text consegue preencher a partir do texto
+TEXT_FIELD_KEYS = ("fornecedor_cnpj", "nota_numero", "nota_data", "nota_valor_total", "cpf_associado")
+
+# Vision aceita no máximo 16 imagens por chamada síncrona de batch_annotate_images
+VISION_BATCH_SIZE = 16
+# Lotes de Vision enviados em paralelo (chamadas de rede; o cliente gRPC é thread-safe)
+VISION_MAX_WORKERS = 4
+# Blocos de OCR com confiança (0-1) abaixo disso são descartados
+VISION_MIN_BLOCK_CONFIDENCE = 0.5
+VISION_LANGUAGE_HINTS = ["pt"]
+# Limite de páginas do batch_annotate_files síncrono (PDF enviado direto, sem rasterizar)
+VISION_FILE_MAX_PAGES = 5
+# Páginas de PDF com menos caracteres na camada de texto que isso são tratadas como digitalizadas (vão ao OCR)
+PDF_TEXT_MIN_CHARS = 30
+# ...ou com menos que PDF_TEXT_RICH_CHARS sobre imagens cobrindo PDF_IMAGE_COVERAGE_OCR da página (digitalização com carimbo de texto)
+PDF_TEXT_RICH_CHARS = 200
+PDF_IMAGE_COVERAGE_OCR = 0.5
+
+# Extensões tratadas (tuplas: str.endswith testa todas numa chamada só)
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+SUPPORTED_EXTENSIONS = (".pdf", ".xml") + IMAGE_EXTENSIONS
+
+# Somente os campos exibidos/usados pelo app (size nunca é lido)
+DRIVE_LIST_FIELDS = "nextPageToken, files(id, name, mimeType, modifiedTime)"
+
+DRIVE_DOWNLOAD_CHUNK_SIZE = 10 * 1024 * 1024
+# Arquivos baixados/extraídos em paralelo (Drive + Vision são chamadas de rede)
+FILE_WORKERS = 4
+# Arquivos acumulados antes de gravar DATA/LOGS numa única chamada cada
+SHEETS_FLUSH_FILES = 20
+# Novas tentativas com backoff exponencial no Sheets: leituras em 429/5xx (num_retries do googleapiclient),
+# escritas só em 429 (execute_sheets_write)
+SHEETS_NUM_RETRIES = 5
+# Quantos arquivos extraídos ficam em cache (st.cache_data) por processo
+EXTRACTION_CACHE_MAX_ENTRIES = 500
+
+# Acima de FILES_PREVIEW_MAX arquivos a tabela mostra apenas FILES_PREVIEW_ROWS linhas
+FILES_PREVIEW_MAX = 500
+FILES_PREVIEW_ROWS = 200
+# Linhas do LOGS exibidas ao fim do processamento
+LOGS_PREVIEW_ROWS = 20
 
 DATA_SHEET_NAME = "DATA"
 LOGS_SHEET_NAME = "LOGS"
@@ -73,6 +128,17 @@ SHEET_HEADER = [
 
 LOGS_HEADER = ["drive_file_id", "filename", "processed_at", "status", "rows", "message"]
 
+# Colunas gravadas como número no Sheets (as demais como texto literal)
+NUMERIC_COLUMNS = {
+    "item_index",
+    "item_quantidade",
+    "item_valor_unitario",
+    "item_valor_total",
+    "nota_valor_total",
+    "confidence",
+    "rows"
+}
+
 # -------------------------
 # CREDENTIALS / SERVICES
 # -------------------------
@@ -145,9 +211,15 @@ def build_services():
     creds = service_account.Credentials.from_service_account_info(info, scopes=SCOPES)
     drive_service = build("drive", "v3", credentials=creds, cache_discovery=False)
     sheets_service = build("sheets", "v4", credentials=creds, cache_discovery=False)
+    return drive_service, sheets_service
+
+@st.cache_resource(show_spinner=False)
+def build_vision_client():
+    """Cliente do Vision criado só quando alguma página precisa de OCR (gRPC + vision_v1 pesam no cold start)."""
+    from google.cloud import vision_v1
+    info = load_service_account_info()
     vision_creds = service_account.Credentials.from_service_account_info(info, scopes=[VISION_SCOPE])
-    vision_client = vision_v1.ImageAnnotatorClient(credentials=vision_creds)
-    return drive_service, sheets_service, vision_client
+    return vision_v1.ImageAnnotatorClient(credentials=vision_creds)
 
 # -------------------------
 # DRIVE FUNCTIONS
@@ -155,66 +227,90 @@ def build_services():
 def list_files_in_folder(drive_service, folder_id):
     """Lista arquivos relevantes na pasta do Drive."""
     q = f"'{folder_id}' in parents and trashed=false"
-    fields = "nextPageToken, files(id, name, mimeType, modifiedTime, size)"
+    fields = DRIVE_LIST_FIELDS
     page_token = None
     results = []
     while True:
-        resp = drive_service.files().list(q=q, spaces='drive', fields=fields, pageToken=page_token, pageSize=200).execute()
+        resp = drive_service.files().list(q=q, spaces='drive', fields=fields, pageToken=page_token, pageSize=1000).execute()
         files = resp.get('files', [])
         for f in files:
             name = f.get("name", "").lower()
-            if any(name.endswith(ext) for ext in (".pdf", ".xml", ".jpg", ".jpeg", ".png")):
+            if name.endswith(SUPPORTED_EXTENSIONS):
                 results.append(f)
         page_token = resp.get('nextPageToken', None)
         if not page_token:
             break
     return results
 
-def download_drive_file(drive_service, file_id, dest_path):
+def download_drive_file(drive_service, file_id):
+    """Baixa o arquivo para a memória (NF-e em XML/PDF/imagem são pequenas) e devolve os bytes."""
     request = drive_service.files().get_media(fileId=file_id)
-    fh = io.FileIO(dest_path, 'wb')
-    downloader = MediaIoBaseDownload(fh, request)
+    fh = io.BytesIO()
+    downloader = MediaIoBaseDownload(fh, request, chunksize=DRIVE_DOWNLOAD_CHUNK_SIZE)
     done = False
     while not done:
         status, done = downloader.next_chunk()
-    fh.close()
-    return dest_path
+    return fh.getvalue()
 
 # -------------------------
 # XML PARSER
 # -------------------------
-def parse_nfe_xml(xml_path):
-    """Parse simples para NF-e (cada det -> item)."""
-    tree = etree.parse(xml_path)
-    root = tree.getroot()
-    ns = root.nsmap
+def parse_nfe_xml(xml_source):
+    """
+    Parse simples para NF-e (cada det -> item).
+    Leitura em streaming (iterparse): cada det é liberado logo após ser lido,
+    então a memória não cresce com o número de itens.
+    """
     def find_text(node, path):
         try:
-            el = node.find(path, namespaces=ns)
+            el = node.find(path)
             return el.text.strip() if el is not None and el.text else None
         except Exception:
             return None
 
-    emit = root.find('.//{*}emit')
-    ide = root.find('.//{*}ide')
-    total = root.find('.//{*}total')
-    items = root.findall('.//{*}det')
-
-    fornecedor = find_text(emit, './/{*}xNome') if emit is not None else None
-    cnpj = find_text(emit, './/{*}CNPJ') if emit is not None else None
-    nota_num = find_text(ide, './/{*}nNF') if ide is not None else None
-    nota_data = find_text(ide, './/{*}dEmi') if ide is not None else None
-    nota_valor_total = find_text(total, './/{*}vNF') if total is not None else None
+    from lxml import etree
 
+    fornecedor = cnpj = nota_num = nota_data = nota_valor_total = None
+    seen = set()
+    items = []
+    idx = 0
+    # descarta indentação/comentários e dispensa resolução de entidades e IDs (menos nós e menos hash tables no libxml2)
+    context = etree.iterparse(
+        xml_source, events=("end",), tag=("{*}ide", "{*}emit", "{*}det", "{*}total"),
+        remove_blank_text=True, remove_comments=True, resolve_entities=False, collect_ids=False, huge_tree=False
+    )
+    for _, elem in context:
+        tag = etree.QName(elem).localname
+        if tag == "det":
+            idx += 1
+            prod = elem.find('.//{*}prod')
+            if prod is not None:
+                items.append((
+                    idx,
+                    find_text(prod, './/{*}xProd'),
+                    find_text(prod, './/{*}qCom'),
+                    find_text(prod, './/{*}vUnCom'),
+                    find_text(prod, './/{*}vProd'),
+                ))
+        elif tag not in seen:
+            # como no find('.//...') anterior, vale a primeira ocorrência de cada bloco
+            seen.add(tag)
+            if tag == "emit":
+                fornecedor = find_text(elem, './/{*}xNome')
+                cnpj = find_text(elem, './/{*}CNPJ')
+            elif tag == "ide":
+                nota_num = find_text(elem, './/{*}nNF')
+                nota_data = find_text(elem, './/{*}dEmi')
+            elif tag == "total":
+                nota_valor_total = find_text(elem, './/{*}vNF')
+        elem.clear(keep_tail=True)
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+    del context
+
+    # total vem depois dos det no layout da NF-e, por isso as linhas são montadas no fim
     rows = []
-    for idx, det in enumerate(items, start=1):
-        prod = det.find('.//{*}prod')
-        if prod is None:
-            continue
-        descricao = find_text(prod, './/{*}xProd')
-        qCom = find_text(prod, './/{*}qCom')
-        vUnCom = find_text(prod, './/{*}vUnCom')
-        vProd = find_text(prod, './/{*}vProd')
+    for idx, descricao, qCom, vUnCom, vProd in items:
         rows.append({
             "fornecedor_razao_social": fornecedor,
             "fornecedor_cnpj": cnpj,
@@ -236,29 +332,183 @@ def parse_nfe_xml(xml_path):
 # -------------------------
 # PDF -> imagens
 # -------------------------
-def pdf_to_images(pdf_path, zoom=2):
+# O PyMuPDF não suporta uso a partir de várias threads: toda chamada ao fitz (abrir, ler, renderizar)
+# roda sob esta trava. Download e Vision continuam em paralelo; só o trabalho local com o PDF é serializado.
+_FITZ_LOCK = threading.Lock()
+
+def pdf_to_images(pdf_bytes, zoom=2, pages=None):
+    """Renderiza as páginas (índices base 0; None = todas) como PNG."""
+    import fitz  # PyMuPDF
     images = []
-    doc = fitz.open(pdf_path)
-    mat = fitz.Matrix(zoom, zoom)
-    for page in doc:
-        pix = page.get_pixmap(matrix=mat, alpha=False)
-        images.append(pix.tobytes(output="png"))
-    doc.close()
+    with _FITZ_LOCK:
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        mat = fitz.Matrix(zoom, zoom)
+        for page_index in (range(doc.page_count) if pages is None else pages):
+            # tons de cinza: 1 canal em vez de 3, PNG bem menor para enviar ao Vision
+            pix = doc[page_index].get_pixmap(matrix=mat, colorspace=fitz.csGRAY, alpha=False)
+            images.append(pix.tobytes(output="png"))
+        doc.close()
     return images
 
+def page_needs_ocr(page, text):
+    """
+    Página digitalizada? Sem camada de texto útil (< PDF_TEXT_MIN_CHARS), ou com pouco texto
+    (< PDF_TEXT_RICH_CHARS, ex.: só um carimbo digital) sobre uma imagem que cobre boa parte da página.
+    A área das imagens só é calculada nesse segundo caso.
+    Chamada com _FITZ_LOCK já adquirida (ver extract_pdf_texts).
+    """
+    n_chars = len(text.strip())
+    if n_chars < PDF_TEXT_MIN_CHARS:
+        return True
+    if n_chars >= PDF_TEXT_RICH_CHARS:
+        return False
+    import fitz  # PyMuPDF
+    page_rect = page.rect
+    page_area = page_rect.get_area()
+    if not page_area:
+        return False
+    image_area = sum((fitz.Rect(info["bbox"]) & page_rect).get_area() for info in page.get_image_info())
+    return image_area / page_area >= PDF_IMAGE_COVERAGE_OCR
+
+def extract_pdf_texts(pdf_bytes):
+    """
+    Texto por página do PDF: usa a camada de texto embutida quando ela tem pelo menos
+    PDF_TEXT_MIN_CHARS caracteres e manda ao OCR só as páginas restantes (digitalizadas).
+    Retorna (textos, usou_ocr).
+    """
+    import fitz  # PyMuPDF
+    texts = []
+    missing = []
+    with _FITZ_LOCK:
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        for i, page in enumerate(doc):
+            text = page.get_text("text")
+            texts.append(text)
+            if page_needs_ocr(page, text):
+                missing.append(i)
+        doc.close()
+    if missing:
+        for i, text in zip(missing, vision_pdf_ocr(build_vision_client(), pdf_bytes, pages=missing)):
+            texts[i] = text
+    return texts, bool(missing)
+
 # -------------------------
 # VISION OCR
 # -------------------------
+def vision_annotation_text(annotation):
+    """
+    Texto do full_text_annotation sem os blocos com confiança abaixo de VISION_MIN_BLOCK_CONFIDENCE
+    (carimbos, manchas, rabiscos), que só geram falsos CNPJs/valores nas heurísticas.
+    Sem blocos fracos (caso comum) devolve o .text pronto, sem percorrer os símbolos.
+    """
+    if not annotation:
+        return ""
+    blocks = [block for page in annotation.pages for block in page.blocks]
+    if all(not 0 < block.confidence < VISION_MIN_BLOCK_CONFIDENCE for block in blocks):
+        return annotation.text
+
+    from google.cloud import vision_v1
+    BreakType = vision_v1.TextAnnotation.DetectedBreak.BreakType
+    parts = []
+    for block in blocks:
+        if 0 < block.confidence < VISION_MIN_BLOCK_CONFIDENCE:
+            continue
+        for paragraph in block.paragraphs:
+            for word in paragraph.words:
+                for symbol in word.symbols:
+                    parts.append(symbol.text)
+                    break_type = symbol.property.detected_break.type_
+                    if break_type in (BreakType.SPACE, BreakType.SURE_SPACE):
+                        parts.append(" ")
+                    elif break_type in (BreakType.EOL_SURE_SPACE, BreakType.LINE_BREAK):
+                        parts.append("\n")
+                    elif break_type == BreakType.HYPHEN:
+                        parts.append("-\n")
+    return "".join(parts)
+
+def vision_annotate_images(vision_client, images):
+    """Uma chamada batch_annotate_images para até VISION_BATCH_SIZE imagens; um texto por imagem."""
+    from google.cloud import vision_v1
+    feature = vision_v1.Feature(type_=vision_v1.Feature.Type.DOCUMENT_TEXT_DETECTION)
+    context = vision_v1.ImageContext(language_hints=VISION_LANGUAGE_HINTS)
+    requests = [
+        vision_v1.AnnotateImageRequest(image=vision_v1.Image(content=img_b), features=[feature], image_context=context)
+        for img_b in images
+    ]
+    batch = vision_client.batch_annotate_images(requests=requests)
+    texts = []
+    for response in batch.responses:
+        if response.error.message:
+            raise RuntimeError(response.error.message)
+        texts.append(vision_annotation_text(response.full_text_annotation))
+    return texts
+
 def vision_document_ocr(vision_client, image_bytes):
-    image = vision_v1.Image(content=image_bytes)
-    response = vision_client.document_text_detection(image=image)
-    if response.error.message:
-        raise RuntimeError(response.error.message)
-    return response.full_text_annotation.text if response.full_text_annotation else ""
+    return vision_annotate_images(vision_client, [image_bytes])[0]
+
+def vision_pdf_pages_ocr(vision_client, pdf_bytes, pages):
+    """
+    OCR de muitas páginas de um PDF em pipeline: cada lote de VISION_BATCH_SIZE páginas é renderizado
+    e enviado ao Vision enquanto o próximo é renderizado. No máximo VISION_MAX_WORKERS lotes
+    renderizados ficam em memória ao mesmo tempo, qualquer que seja o tamanho do PDF.
+    """
+    page_chunks = [pages[start:start + VISION_BATCH_SIZE] for start in range(0, len(pages), VISION_BATCH_SIZE)]
+    futures = []
+    with ThreadPoolExecutor(max_workers=min(VISION_MAX_WORKERS, len(page_chunks))) as ex:
+        for chunk in page_chunks:
+            if len(futures) >= VISION_MAX_WORKERS:
+                # espera o lote mais antigo ainda em voo antes de renderizar mais um
+                futures[-VISION_MAX_WORKERS].result()
+            futures.append(ex.submit(vision_annotate_images, vision_client, pdf_to_images(pdf_bytes, zoom=2, pages=chunk)))
+    return [text for future in futures for text in future.result()]
+
+def vision_pdf_ocr(vision_client, pdf_bytes, pages=None):
+    """
+    OCR das páginas de um PDF (índices base 0; None = todas), um texto por página.
+    Até VISION_FILE_MAX_PAGES páginas o PDF vai inteiro ao Vision numa única chamada
+    (sem rasterizar localmente); acima disso as páginas são renderizadas e enviadas em lotes de imagens
+    (vision_pdf_pages_ocr).
+    """
+    import fitz  # PyMuPDF
+    from google.cloud import vision_v1
+    if pages is None:
+        with _FITZ_LOCK:
+            doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+            pages = list(range(doc.page_count))
+            doc.close()
+    if not pages:
+        return []
+    if len(pages) > VISION_FILE_MAX_PAGES:
+        return vision_pdf_pages_ocr(vision_client, pdf_bytes, pages)
+
+    request = vision_v1.AnnotateFileRequest(
+        input_config=vision_v1.InputConfig(content=pdf_bytes, mime_type="application/pdf"),
+        features=[vision_v1.Feature(type_=vision_v1.Feature.Type.DOCUMENT_TEXT_DETECTION)],
+        image_context=vision_v1.ImageContext(language_hints=VISION_LANGUAGE_HINTS),
+        pages=[i + 1 for i in pages],
+    )
+    file_response = vision_client.batch_annotate_files(requests=[request]).responses[0]
+    if file_response.error.message:
+        raise RuntimeError(file_response.error.message)
+    texts = []
+    for response in file_response.responses:
+        if response.error.message:
+            raise RuntimeError(response.error.message)
+        texts.append(vision_annotation_text(response.full_text_annotation))
+    return texts
 
 # -------------------------
 # HEURÍSTICAS DE EXTRAÇÃO
 # -------------------------
+def parse_money_value(value):
+    """
+    Converte um match de VALUE_REGEX em Decimal sem regex: o padrão sempre termina
+    em separador + 2 dígitos, então basta tirar pontos/vírgulas e recolocar os centavos.
+    Vale tanto para "1.234,56" quanto para "1234.56".
+    """
+    digits = value.translate(MONEY_SEPARATORS)
+    return Decimal(f"{digits[:-2]}.{digits[-2:]}")
+
 def extract_basic_fields_from_text(text):
     cnpj = None
     cpf = None
@@ -266,32 +516,30 @@ def extract_basic_fields_from_text(text):
     nota_data = None
     probable_totals = []
 
-    cnpj_m = CNPJ_REGEX.search(text)
-    if cnpj_m:
-        cnpj = re.sub(r'\D', '', cnpj_m.group(0))
-    cpf_m = CPF_REGEX.search(text)
-    if cpf_m:
-        cpf = re.sub(r'\D', '', cpf_m.group(0))
-    nn = NOTE_NUMBER_REGEX.search(text)
-    if nn:
-        nota_num = nn.group(1)
-    dm = DATE_REGEX.search(text)
-    if dm:
+    # uma única varredura para CNPJ, CPF, número e data; para assim que os quatro aparecem
+    found = {}
+    for m in FIELDS_REGEX.finditer(text):
+        if m.lastgroup not in found:
+            found[m.lastgroup] = m.group(m.lastgroup)
+            if len(found) == 4:
+                break
+    if "cnpj" in found:
+        cnpj = found["cnpj"].translate(DOCUMENT_PUNCTUATION)
+    if "cpf" in found:
+        cpf = found["cpf"].translate(DOCUMENT_PUNCTUATION)
+    if "nota" in found:
+        nota_num = found["nota"]
+    if "date" in found:
+        raw_date = found["date"]
         try:
-            nota_data = dateparser.parse(dm.group(1), dayfirst=True).date().isoformat()
+            # dayfirst só vale para dd/mm/aaaa; com ISO (aaaa-mm-dd) ele trocaria dia e mês
+            nota_data = dateparser.parse(raw_date, dayfirst="/" in raw_date).date().isoformat()
         except Exception:
-            nota_data = dm.group(1)
+            nota_data = raw_date
 
-    vals = VALUE_REGEX.findall(text)
-    cleaned = []
-    for v in vals:
-        vv = v.replace('.', '').replace(',', '.')
-        try:
-            cleaned.append(Decimal(vv))
-        except Exception:
-            continue
-    cleaned.sort(reverse=True)
-    nota_valor_total = str(cleaned[0]) if cleaned else None
+    # total = maior valor monetário do texto; gerador sobre finditer, sem lista intermediária
+    max_value = max((parse_money_value(m.group(0)) for m in VALUE_REGEX.finditer(text)), default=None)
+    nota_valor_total = str(max_value) if max_value is not None else None
 
     return {
         "fornecedor_razao_social": None,
@@ -304,26 +552,27 @@ def extract_basic_fields_from_text(text):
     }
 
 def extract_items_from_text_lines(text):
-    lines = [l.strip() for l in text.splitlines() if l.strip()]
+    """
+    Uma única varredura de VALUE_REGEX sobre o texto inteiro; os valores são
+    agrupados pela linha em que caem (sem splitlines nem regex por linha).
+    """
+    lines = []  # (inicio_da_linha, inicio_do_primeiro_valor, [valores])
+    line_end = -1
+    for m in VALUE_REGEX.finditer(text):
+        if m.start() > line_end:
+            line_start = text.rfind("\n", 0, m.start()) + 1
+            line_end = text.find("\n", m.end())
+            if line_end == -1:
+                line_end = len(text)
+            lines.append((line_start, m.start(), []))
+        lines[-1][2].append(m.group(0))
+
     items = []
-    idx = 0
-    for line in lines:
-        values = VALUE_REGEX.findall(line)
-        if not values:
-            continue
-        first_val_match = VALUE_REGEX.search(line)
-        desc = line[:first_val_match.start()].strip() if first_val_match else line
-        last_vals = values[-2:] if len(values) >= 2 else values
-        unit = None; total = None
-        try:
-            if len(last_vals) == 2:
-                unit = Decimal(last_vals[-2].replace('.', '').replace(',', '.'))
-                total = Decimal(last_vals[-1].replace('.', '').replace(',', '.'))
-            else:
-                total = Decimal(last_vals[-1].replace('.', '').replace(',', '.'))
-        except Exception:
-            pass
-        idx += 1
+    for idx, (line_start, first_val_start, values) in enumerate(lines, start=1):
+        desc = text[line_start:first_val_start].strip()
+        last_vals = values[-2:]
+        unit = parse_money_value(last_vals[-2]) if len(last_vals) == 2 else None
+        total = parse_money_value(last_vals[-1])
         items.append({
             "item_index": idx,
             "item_descricao": desc or None,
@@ -336,16 +585,16 @@ def extract_items_from_text_lines(text):
 # -------------------------
 # BUILD ROWS
 # -------------------------
-def build_rows_from_extraction(filename, file_id, xml_rows=None, ocr_text=None, ocr_items=None, metodo="xml"):
+def build_rows_from_extraction(filename, file_id, xml_rows=None, ocr_text=None, ocr_items=None, metodo="xml", processed_at=None):
     rows = []
-    processed_at = datetime.utcnow().isoformat()
+    processed_at = processed_at or datetime.utcnow().isoformat()
     if metodo == "xml" and xml_rows:
         for r in xml_rows:
             rows.append({
                 "source_filename": filename,
                 "drive_file_id": file_id,
                 "fornecedor_razao_social": r.get("fornecedor_razao_social"),
-                "fornecedor_cnpj": re.sub(r'\D', '', (r.get("fornecedor_cnpj") or "")) if r.get("fornecedor_cnpj") else None,
+                "fornecedor_cnpj": NON_DIGIT_REGEX.sub('', r.get("fornecedor_cnpj")) if r.get("fornecedor_cnpj") else None,
                 "nota_numero": r.get("nota_numero"),
                 "nota_data": r.get("nota_data"),
                 "item_index": r.get("item_index"),
@@ -387,6 +636,27 @@ def build_rows_from_extraction(filename, file_id, xml_rows=None, ocr_text=None,
 # -------------------------
 # SHEETS HELPERS
 # -------------------------
+def execute_sheets_write(request):
+    """
+    Executa uma escrita no Sheets repetindo só em 429. O num_retries do googleapiclient repete também
+    em 5xx/timeout, e um append que chegou a ser gravado seria gravado de novo (linhas duplicadas);
+    o 429 é recusado antes de qualquer gravação, então repetir é seguro.
+    """
+    for attempt in range(SHEETS_NUM_RETRIES + 1):
+        try:
+            return request.execute()
+        except HttpError as e:
+            if e.resp.status != 429 or attempt == SHEETS_NUM_RETRIES:
+                raise
+            time.sleep(min(2 ** attempt, 32) + random.random())
+
+def write_headers(sheets_service, spreadsheet_id, sheet_names):
+    headers = {DATA_SHEET_NAME: SHEET_HEADER, LOGS_SHEET_NAME: LOGS_HEADER}
+    data = [{"range": f"{name}!A1", "values": [headers[name]]} for name in sheet_names]
+    execute_sheets_write(sheets_service.spreadsheets().values().batchUpdate(
+        spreadsheetId=spreadsheet_id, body={"valueInputOption": "RAW", "data": data}
+    ))
+
 def create_spreadsheet_if_missing(sheets_service, spreadsheet_id, title="Notas_Extracao"):
     if spreadsheet_id:
         return spreadsheet_id
@@ -399,65 +669,169 @@ def create_spreadsheet_if_missing(sheets_service, spreadsheet_id, title="Notas_E
     }
     resp = sheets_service.spreadsheets().create(body=body).execute()
     new_id = resp.get("spreadsheetId")
-    # write headers
-    header_range = f"{DATA_SHEET_NAME}!A1"
-    sheets_service.spreadsheets().values().update(
-        spreadsheetId=new_id, range=header_range, valueInputOption="RAW",
-        body={"values":[SHEET_HEADER]}
-    ).execute()
-    logs_range = f"{LOGS_SHEET_NAME}!A1"
-    sheets_service.spreadsheets().values().update(
-        spreadsheetId=new_id, range=logs_range, valueInputOption="RAW",
-        body={"values":[LOGS_HEADER]}
-    ).execute()
+    # write headers (as duas abas numa única chamada)
+    write_headers(sheets_service, new_id, [DATA_SHEET_NAME, LOGS_SHEET_NAME])
     return new_id
 
 def ensure_sheets_and_headers(sheets_service, spreadsheet_id):
-    # ensure DATA and LOGS exist and have headers
-    meta = sheets_service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
-    titles = [s["properties"]["title"] for s in meta.get("sheets", [])]
+    """Garante as abas DATA e LOGS com cabeçalho e retorna {título: sheetId} (usado pelo appendCells)."""
+    meta = sheets_service.spreadsheets().get(spreadsheetId=spreadsheet_id, fields="sheets.properties(sheetId,title)").execute(num_retries=SHEETS_NUM_RETRIES)
+    sheet_ids = {s["properties"]["title"]: s["properties"]["sheetId"] for s in meta.get("sheets", [])}
     requests = []
-    if DATA_SHEET_NAME not in titles:
+    if DATA_SHEET_NAME not in sheet_ids:
         requests.append({"addSheet": {"properties": {"title": DATA_SHEET_NAME}}})
-    if LOGS_SHEET_NAME not in titles:
+    if LOGS_SHEET_NAME not in sheet_ids:
         requests.append({"addSheet": {"properties": {"title": LOGS_SHEET_NAME}}})
     if requests:
-        sheets_service.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body={"requests": requests}).execute()
-    # ensure headers present
-    try:
-        df_head = sheets_service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=f"{DATA_SHEET_NAME}!A1:Z1").execute()
-        if "values" not in df_head or not df_head["values"]:
-            sheets_service.spreadsheets().values().update(spreadsheetId=spreadsheet_id, range=f"{DATA_SHEET_NAME}!A1", valueInputOption="RAW", body={"values":[SHEET_HEADER]}).execute()
-    except Exception:
-        sheets_service.spreadsheets().values().update(spreadsheetId=spreadsheet_id, range=f"{DATA_SHEET_NAME}!A1", valueInputOption="RAW", body={"values":[SHEET_HEADER]}).execute()
+        resp = execute_sheets_write(sheets_service.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body={"requests": requests}))
+        for reply in resp.get("replies", []):
+            props = reply["addSheet"]["properties"]
+            sheet_ids[props["title"]] = props["sheetId"]
+    # ensure headers present: uma leitura para as duas abas e no máximo uma escrita
+    names = [DATA_SHEET_NAME, LOGS_SHEET_NAME]
     try:
-        logs_head = sheets_service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=f"{LOGS_SHEET_NAME}!A1:Z1").execute()
-        if "values" not in logs_head or not logs_head["values"]:
-            sheets_service.spreadsheets().values().update(spreadsheetId=spreadsheet_id, range=f"{LOGS_SHEET_NAME}!A1", valueInputOption="RAW", body={"values":[LOGS_HEADER]}).execute()
+        resp = sheets_service.spreadsheets().values().batchGet(spreadsheetId=spreadsheet_id, ranges=[f"{name}!A1:Z1" for name in names]).execute(num_retries=SHEETS_NUM_RETRIES)
+        value_ranges = resp.get("valueRanges", [])
     except Exception:
-        sheets_service.spreadsheets().values().update(spreadsheetId=spreadsheet_id, range=f"{LOGS_SHEET_NAME}!A1", valueInputOption="RAW", body={"values":[LOGS_HEADER]}).execute()
+        value_ranges = []
+    missing = [name for i, name in enumerate(names) if i >= len(value_ranges) or not value_ranges[i].get("values")]
+    if missing:
+        write_headers(sheets_service, spreadsheet_id, missing)
+    return sheet_ids
 
 def read_processed_file_ids(sheets_service, spreadsheet_id):
     """Lê o LOGS e retorna set de drive_file_id já processados."""
     try:
-        resp = sheets_service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=f"{LOGS_SHEET_NAME}!A2:A10000").execute()
-        rows = resp.get("values", [])
-        return set(r[0] for r in rows if r)
+        # majorDimension=COLUMNS devolve a coluna como uma lista plana (sem uma lista por linha)
+        resp = sheets_service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=f"{LOGS_SHEET_NAME}!A2:A", majorDimension="COLUMNS").execute(num_retries=SHEETS_NUM_RETRIES)
+        columns = resp.get("values", [])
+        return set(fid for fid in columns[0] if fid) if columns else set()
     except Exception:
         return set()
 
-def append_rows_to_sheet(sheets_service, spreadsheet_id, rows, sheet_name=DATA_SHEET_NAME):
-    if not rows:
+def to_sheet_cell(value, numeric=False):
+    """
+    CellData do appendCells. Valores numéricos (colunas em NUMERIC_COLUMNS) vão como número,
+    independente da localidade da planilha; o resto vai como texto literal, preservando
+    CNPJ, número da nota e datas exatamente como extraídos.
+    """
+    if value is None or value == "":
+        return {}
+    if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+        return {"userEnteredValue": {"numberValue": float(value)}}
+    if numeric:
+        try:
+            return {"userEnteredValue": {"numberValue": float(value)}}
+        except (TypeError, ValueError):
+            pass
+    return {"userEnteredValue": {"stringValue": str(value)}}
+
+def append_cells_request(sheet_id, rows, header):
+    flags = [h in NUMERIC_COLUMNS for h in header]
+    return {"appendCells": {
+        "sheetId": sheet_id,
+        "rows": [{"values": [to_sheet_cell(v, numeric) for v, numeric in zip(row, flags)]} for row in rows],
+        "fields": "userEnteredValue"
+    }}
+
+def append_log_entries(sheets_service, spreadsheet_id, log_rows):
+    if not log_rows:
         return {"updatedRows": 0}
-    values = [[r.get(h) for h in SHEET_HEADER] for r in rows]
-    body = {"values": values}
-    resp = sheets_service.spreadsheets().values().append(spreadsheetId=spreadsheet_id, range=f"{sheet_name}!A1", valueInputOption="USER_ENTERED", insertDataOption="INSERT_ROWS", body=body).execute()
+    body = {"values": log_rows}
+    # RAW: mesmos valores literais do appendCells (o Sheets não reinterpreta datas/números)
+    resp = execute_sheets_write(sheets_service.spreadsheets().values().append(spreadsheetId=spreadsheet_id, range=f"{LOGS_SHEET_NAME}!A1", valueInputOption="RAW", insertDataOption="INSERT_ROWS", body=body))
     return resp
 
-def append_log_entry(sheets_service, spreadsheet_id, log_row):
-    body = {"values": [log_row]}
-    resp = sheets_service.spreadsheets().values().append(spreadsheetId=spreadsheet_id, range=f"{LOGS_SHEET_NAME}!A1", valueInputOption="USER_ENTERED", insertDataOption="INSERT_ROWS", body=body).execute()
-    return resp
+def flush_pending_results(sheets_service, spreadsheet_id, sheet_ids, pending, log_rows, processed_at=None):
+    """
+    Grava as linhas de vários arquivos no DATA e os respectivos logs no LOGS numa única
+    requisição (spreadsheets.batchUpdate com dois appendCells; a cota do Sheets é por requisição).
+    pending: lista de (file_id, filename, rows, detalhe). Esvazia as duas listas.
+    processed_at: horário gravado nos logs OK/FAILED_SHEETS (padrão: agora).
+    Se o batchUpdate falhar (é atômico), os arquivos vão para o LOGS como FAILED_SHEETS.
+    Retorna (linhas gravadas, mensagem de erro ou None, linhas gravadas no LOGS).
+    """
+    if not pending and not log_rows:
+        return 0, None, []
+    now = processed_at or datetime.utcnow().isoformat()
+    ok_logs = [[fid, fname, now, "OK", len(rows), detail] for fid, fname, rows, detail in pending]
+    data_values = [[r.get(h) for h in SHEET_HEADER] for _, _, rows, _ in pending for r in rows]
+    requests = []
+    if data_values:
+        requests.append(append_cells_request(sheet_ids[DATA_SHEET_NAME], data_values, SHEET_HEADER))
+    requests.append(append_cells_request(sheet_ids[LOGS_SHEET_NAME], log_rows + ok_logs, LOGS_HEADER))
+
+    written = 0
+    error = None
+    try:
+        execute_sheets_write(sheets_service.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body={"requests": requests}))
+        written = len(data_values)
+        logged = log_rows + ok_logs
+    except Exception as e:
+        error = str(e)
+        failed_logs = [[fid, fname, now, "FAILED_SHEETS", 0, error] for fid, fname, _, _ in pending]
+        logged = log_rows + failed_logs
+        append_log_entries(sheets_service, spreadsheet_id, logged)
+    pending.clear()
+    log_rows.clear()
+    return written, error, logged
+
+# -------------------------
+# EXTRAÇÃO POR ARQUIVO
+# -------------------------
+class DriveDownloadError(RuntimeError):
+    """Falha ao baixar o arquivo do Drive (registrada como FAILED_DOWNLOAD no LOGS)."""
+
+@st.cache_data(show_spinner=False, max_entries=EXTRACTION_CACHE_MAX_ENTRIES)
+def extract_drive_file(_drive_service, file_id, filename, modified_time=None):
+    """
+    Baixa e extrai um arquivo do Drive. Retorna (metodo, mensagem, kwargs de build_rows_from_extraction);
+    metodo é None quando o formato não é suportado.
+    Cacheado em memória por file_id/filename/modifiedTime: reprocessar um arquivo que não mudou
+    no Drive não repete download nem OCR. Nada vai para disco (o resultado tem CNPJs e CPFs).
+    Exceções não entram no cache, então falhas transitórias são tentadas de novo no próximo clique.
+    O arquivo é tratado todo em memória, sem arquivo temporário em disco.
+    """
+    try:
+        data = download_drive_file(_drive_service, file_id)
+    except Exception as e:
+        raise DriveDownloadError(str(e)) from e
+
+    lower = filename.lower()
+    if lower.endswith(".xml"):
+        return "xml", "", {"xml_rows": parse_nfe_xml(io.BytesIO(data))}
+    if lower.endswith(".pdf"):
+        combined_items = []
+        base_info = {"fornecedor_razao_social": None, "fornecedor_cnpj": None, "nota_numero": None, "nota_data": None, "nota_valor_total": None, "cpf_associado": None, "observacoes": ""}
+        texts, used_ocr = extract_pdf_texts(data)
+        for text in texts:
+            # vale o primeiro valor de cada campo: com todos preenchidos, as páginas seguintes só contribuem itens
+            if any(base_info[k] is None for k in TEXT_FIELD_KEYS):
+                info = extract_basic_fields_from_text(text)
+                for k, v in info.items():
+                    if base_info.get(k) is None and v:
+                        base_info[k] = v
+            combined_items.extend(extract_items_from_text_lines(text))
+        method = "vision" if used_ocr else "pdf_text"
+        return method, "", {"ocr_text": base_info, "ocr_items": combined_items}
+    if lower.endswith(IMAGE_EXTENSIONS):
+        text = vision_document_ocr(build_vision_client(), data)
+        return "vision", "", {"ocr_text": extract_basic_fields_from_text(text), "ocr_items": extract_items_from_text_lines(text)}
+    return None, "Formato não suportado", {}
+
+_thread_local = threading.local()
+
+def thread_drive_service():
+    """Drive service próprio de cada thread: o httplib2 por trás do googleapiclient não é thread-safe."""
+    drive_service = getattr(_thread_local, "drive_service", None)
+    if drive_service is None:
+        creds = service_account.Credentials.from_service_account_info(load_service_account_info(), scopes=SCOPES)
+        drive_service = build("drive", "v3", credentials=creds, cache_discovery=False)
+        _thread_local.drive_service = drive_service
+    return drive_service
+
+def extract_drive_file_in_worker(file_id, filename, modified_time=None):
+    return extract_drive_file(thread_drive_service(), file_id, filename, modified_time)
 
 # -------------------------
 # MAIN UI / ORCHESTRATION
@@ -466,7 +840,7 @@ def main():
     st.set_page_config(page_title="Leitura de Notas - Streamlit", layout="wide")
     st.title("Leitura de Notas Fiscais — XML-first + Vision (com LOGS e idempotência)")
 
-    drive_service, sheets_service, vision_client = build_services()
+    drive_service, sheets_service = build_services()
 
     st.sidebar.header("Configurações")
     folder_id = st.sidebar.text_input("Drive Folder ID", value=st.secrets.get("default_drive_folder_id", ""))
@@ -483,13 +857,18 @@ def main():
         with st.spinner("Listando arquivos..."):
             files = list_files_in_folder(drive_service, folder_id)
             st.session_state["drive_files"] = files
+            # nova listagem relê o LOGS no próximo processamento (pega o que outras sessões gravaram)
+            st.session_state.pop("processed_ids", None)
             st.success(f"{len(files)} arquivo(s) encontrados.")
     files = st.session_state.get("drive_files", [])
 
     st.subheader("Arquivos encontrados")
     if files:
-        df_files = pd.DataFrame([{"name": f.get("name"), "id": f.get("id"), "mimeType": f.get("mimeType"), "modifiedTime": f.get("modifiedTime")} for f in files])
-        st.dataframe(df_files)
+        # pastas grandes: só as primeiras linhas vão para o navegador
+        preview = files[:FILES_PREVIEW_ROWS] if len(files) > FILES_PREVIEW_MAX else files
+        st.dataframe([{"name": f.get("name"), "id": f.get("id"), "mimeType": f.get("mimeType"), "modifiedTime": f.get("modifiedTime")} for f in preview])
+        if len(preview) < len(files):
+            st.caption(f"Exibindo {len(preview)} de {len(files)} arquivos.")
     else:
         st.info("Clique em 'Listar arquivos na pasta' para ver arquivos.")
 
@@ -501,91 +880,120 @@ def main():
     if st.button("Processar arquivos selecionados"):
         # create spreadsheet if needed
         spreadsheet_id = create_spreadsheet_if_missing(sheets_service, spreadsheet_id_input, title="Notas_Extracao")
-        ensure_sheets_and_headers(sheets_service, spreadsheet_id)
-        processed_ids = read_processed_file_ids(sheets_service, spreadsheet_id)
-        overall_rows = []
+        # abas e cabeçalhos conferidos uma vez por planilha na sessão: os cliques seguintes não repetem get + batchGet
+        known_sheet_ids = st.session_state.setdefault("sheet_ids", {})
+        sheet_ids = known_sheet_ids.get(spreadsheet_id)
+        if sheet_ids is None:
+            sheet_ids = known_sheet_ids[spreadsheet_id] = ensure_sheets_and_headers(sheets_service, spreadsheet_id)
+        # ids já processados lidos uma vez por planilha; o set só recebe ids depois que o LOGS foi gravado (flush)
+        known_processed_ids = st.session_state.setdefault("processed_ids", {})
+        processed_ids = known_processed_ids.get(spreadsheet_id)
+        if processed_ids is None:
+            processed_ids = known_processed_ids[spreadsheet_id] = read_processed_file_ids(sheets_service, spreadsheet_id)
+        # resultados acumulados e gravados em lote a cada SHEETS_FLUSH_FILES arquivos
+        pending = []
+        pending_logs = []
+        # um único horário para a execução inteira (DATA e LOGS)
+        run_at = datetime.utcnow().isoformat()
         progress = st.progress(0)
         total = len(to_process)
-        for i, f in enumerate(to_process):
-            fname = f.get("name")
-            fid = f.get("id")
-            if process_only_new and fid in processed_ids:
-                st.info(f"Pulado (já processado): {fname}")
-                progress.progress(int((i+1)/total*100))
-                continue
-            st.info(f"Processando: {fname}")
-            tmp = tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(fname)[1])
-            tmp.close()
-            try:
-                download_drive_file(drive_service, fid, tmp.name)
-            except Exception as e:
-                st.error(f"Erro ao baixar {fname}: {e}")
-                append_log_entry(sheets_service, spreadsheet_id, [fid, fname, datetime.utcnow().isoformat(), "FAILED_DOWNLOAD", 0, str(e)])
-                progress.progress(int((i+1)/total*100))
-                continue
-
-            extracted_rows = []
-            method = None
-            message = ""
-            try:
-                if fname.lower().endswith(".xml"):
-                    xml_rows = parse_nfe_xml(tmp.name)
-                    extracted_rows = build_rows_from_extraction(fname, fid, xml_rows=xml_rows, metodo="xml")
-                    method = "xml"
-                elif fname.lower().endswith(".pdf"):
-                    images = pdf_to_images(tmp.name, zoom=2)
-                    combined_items = []
-                    base_info = {"fornecedor_razao_social": None, "fornecedor_cnpj": None, "nota_numero": None, "nota_data": None, "nota_valor_total": None, "cpf_associado": None, "observacoes": ""}
-                    for img_b in images:
-                        text = vision_document_ocr(vision_client, img_b)
-                        info = extract_basic_fields_from_text(text)
-                        for k, v in info.items():
-                            if base_info.get(k) is None and v:
-                                base_info[k] = v
-                        items = extract_items_from_text_lines(text)
-                        combined_items.extend(items)
-                    extracted_rows = build_rows_from_extraction(fname, fid, xml_rows=None, ocr_text=base_info, ocr_items=combined_items, metodo="vision")
-                    method = "vision"
-                elif any(fname.lower().endswith(ext) for ext in [".jpg", ".jpeg", ".png"]):
-                    with open(tmp.name, "rb") as fimg:
-                        img_b = fimg.read()
-                    text = vision_document_ocr(vision_client, img_b)
-                    base_info = extract_basic_fields_from_text(text)
-                    items = extract_items_from_text_lines(text)
-                    extracted_rows = build_rows_from_extraction(fname, fid, xml_rows=None, ocr_text=base_info, ocr_items=items, metodo="vision")
-                    method = "vision"
-                else:
-                    message = "Formato não suportado"
-            except Exception as e:
-                st.error(f"Erro ao processar {fname}: {e}")
-                message = str(e)
-
-            # append to sheet if we have rows
-            if extracted_rows:
-                try:
-                    append_rows_to_sheet(sheets_service, spreadsheet_id, extracted_rows, sheet_name=DATA_SHEET_NAME)
-                    append_log_entry(sheets_service, spreadsheet_id, [fid, fname, datetime.utcnow().isoformat(), "OK", len(extracted_rows), method or message])
-                    st.success(f"{len(extracted_rows)} linhas adicionadas (arquivo: {fname}).")
-                except Exception as e:
-                    st.error(f"Erro ao gravar no Sheets: {e}")
-                    append_log_entry(sheets_service, spreadsheet_id, [fid, fname, datetime.utcnow().isoformat(), "FAILED_SHEETS", 0, str(e)])
+        # status por arquivo, erros e totais gravados são exibidos uma vez no fim: cada st.* no laço é uma ida ao navegador
+        file_log = []
+        errors = []
+        # prévia do LOGS montada com o que esta execução gravou (sem reler a planilha no fim)
+        run_logs = []
+        rows_written = 0
+        files_written = 0
+
+        def flush():
+            nonlocal rows_written, files_written
+            n_files = len(pending)
+            written, error, logged = flush_pending_results(sheets_service, spreadsheet_id, sheet_ids, pending, pending_logs, processed_at=run_at)
+            run_logs.extend(logged[:LOGS_PREVIEW_ROWS - len(run_logs)])
+            if error:
+                # aba pode ter sido apagada/renomeada: confere de novo no próximo clique
+                known_sheet_ids.pop(spreadsheet_id, None)
+                known_processed_ids.pop(spreadsheet_id, None)
+                errors.append(f"Erro ao gravar no Sheets ({n_files} arquivo(s)): {error}")
             else:
-                st.warning(f"Nenhuma linha extraída de {fname}.")
-                append_log_entry(sheets_service, spreadsheet_id, [fid, fname, datetime.utcnow().isoformat(), "NO_ROWS", 0, message or method])
-
-            # mark as processed for this run
-            processed_ids.add(fid)
-            progress.progress(int((i+1)/total*100))
-
-        st.success("Processamento finalizado. Verifique a planilha.")
-        # show preview of recent logs
+                rows_written += written
+                files_written += n_files
+                # execução interrompida antes do flush não marca nada: os arquivos voltam no próximo clique
+                processed_ids.update(row[0] for row in logged)
+
+        done = 0
+        last_pct = -1
+
+        def advance(n=1):
+            nonlocal done, last_pct
+            done += n
+            pct = int(done/total*100) if total else 0
+            # a barra só é reenviada quando a porcentagem muda
+            if pct != last_pct:
+                last_pct = pct
+                progress.progress(pct)
+
+        to_run = []
+        for f in to_process:
+            if process_only_new and f.get("id") in processed_ids:
+                file_log.append(f"Pulado (já processado): {f.get('name')}")
+            else:
+                to_run.append(f)
+        if total:
+            advance(total - len(to_run))
+
+        # download + extração em paralelo (trabalho de rede: Drive e Vision; o fitz roda sob _FITZ_LOCK);
+        # Sheets e st.* só nesta thread. Resultados consumidos na ordem da seleção, então o DATA mantém essa ordem.
+        ctx = get_script_run_ctx()
+        ex = ThreadPoolExecutor(max_workers=FILE_WORKERS, initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx))
         try:
-            logs = sheets_service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=f"{LOGS_SHEET_NAME}!A1:F20").execute().get("values", [])
-            if logs:
-                st.markdown("Últimos registros (LOGS):")
-                st.dataframe(pd.DataFrame(logs[1:], columns=logs[0]))
-        except Exception:
-            pass
+            futures = [ex.submit(extract_drive_file_in_worker, f.get("id"), f.get("name"), f.get("modifiedTime")) for f in to_run]
+            for f, future in zip(to_run, futures):
+                fname = f.get("name")
+                fid = f.get("id")
+                extracted_rows = []
+                method = None
+                message = ""
+                try:
+                    method, message, extraction = future.result()
+                    if method:
+                        extracted_rows = build_rows_from_extraction(fname, fid, metodo=method, processed_at=run_at, **extraction)
+                except DriveDownloadError as e:
+                    errors.append(f"Erro ao baixar {fname}: {e}")
+                    pending_logs.append([fid, fname, run_at, "FAILED_DOWNLOAD", 0, str(e)])
+                    advance()
+                    continue
+                except Exception as e:
+                    errors.append(f"Erro ao processar {fname}: {e}")
+                    message = str(e)
+
+                if extracted_rows:
+                    file_log.append(f"Processado: {fname}")
+                    pending.append((fid, fname, extracted_rows, method or message))
+                    if len(pending) >= SHEETS_FLUSH_FILES:
+                        flush()
+                else:
+                    file_log.append(f"Nenhuma linha extraída: {fname}")
+                    pending_logs.append([fid, fname, run_at, "NO_ROWS", 0, message or method])
+
+                advance()
+        finally:
+            # execução interrompida (rerun/stop ou erro): descarta o que ainda está na fila em vez de
+            # baixar e extrair o resto da seleção antes do rerun
+            ex.shutdown(wait=False, cancel_futures=True)
+
+        flush()
+        st.success(f"Processamento finalizado: {rows_written} linhas adicionadas ({files_written} arquivo(s)). Verifique a planilha.")
+        if errors:
+            st.error(f"{len(errors)} erro(s) durante o processamento.")
+            with st.expander("Erros"):
+                st.code("\n".join(errors), language=None)
+        if file_log:
+            with st.expander(f"Detalhes por arquivo ({len(file_log)})"):
+                st.code("\n".join(file_log), language=None)
+        if run_logs:
+            st.markdown("Registros desta execução (LOGS):")
+            st.dataframe([dict(zip(LOGS_HEADER, row)) for row in run_logs])
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,39 @@
+import unittest
+from unittest import mock
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+import streamlit_app as app
+
+
+class FakeRequest:
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+        self.calls = 0
+
+    def execute(self):
+        self.calls += 1
+        status = self.statuses.pop(0)
+        if status != 200:
+            raise HttpError(httplib2.Response({"status": status}), b"")
+        return {"ok": True}
+
+
+@mock.patch.object(app.time, "sleep")
+class ExecuteSheetsWriteTest(unittest.TestCase):
+    def test_repete_em_429(self, sleep):
+        request = FakeRequest([429, 429, 200])
+        self.assertEqual(app.execute_sheets_write(request), {"ok": True})
+        self.assertEqual(request.calls, 3)
+
+    def test_nao_repete_em_5xx(self, sleep):
+        # a escrita pode ter sido gravada: repetir duplicaria as linhas
+        request = FakeRequest([503, 200])
+        with self.assertRaises(HttpError):
+            app.execute_sheets_write(request)
+        self.assertEqual(request.calls, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,35 @@
+import unittest
+from decimal import Decimal
+
+import streamlit_app as app
+
+
+class ValueRegexTest(unittest.TestCase):
+    def test_valores_com_e_sem_separador_de_milhar(self):
+        text = "1.234,56 1234,56 1,234.56 10.50 0,99 1234567,89"
+        self.assertEqual(
+            app.VALUE_REGEX.findall(text),
+            ["1.234,56", "1234,56", "1,234.56", "10.50", "0,99", "1234567,89"],
+        )
+
+    def test_nao_casa_dentro_da_chave_de_acesso(self):
+        chave = "3523 0112 3456 7800 0199 5500 1000 0012 3410 0001 2345"
+        self.assertEqual(app.VALUE_REGEX.findall(chave.replace(" ", "")), [])
+
+    def test_item_sem_separador_de_milhar(self):
+        items = app.extract_items_from_text_lines("Prod 1234,56")
+        self.assertEqual(len(items), 1)
+        self.assertEqual(items[0]["item_descricao"], "Prod")
+        self.assertEqual(items[0]["item_valor_total"], Decimal("1234.56"))
+
+    def test_total_sem_separador_de_milhar(self):
+        info = app.extract_basic_fields_from_text("Prod 1234,56\nOutro 10,00")
+        self.assertEqual(info["nota_valor_total"], "1234.56")
+
+    def test_total_danfe_e_o_maior_valor(self):
+        text = "CÁLCULO DO IMPOSTO ... VALOR TOTAL DA NOTA\n0,00 0,00 1.000,00 50,00 0,00 1.050,00"
+        self.assertEqual(app.extract_basic_fields_from_text(text)["nota_valor_total"], "1050.00")
+
+
+if __name__ == "__main__":
+    unittest.main()